@@ -17,6 +17,17 @@
 # lookup of values by key.
 
 from collections.abc import Mapping
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import weakref
 
 # Class for the node objects.
 class _dlnode:
@@ -44,6 +55,10 @@ class lrucache:
 
         self.listSize = 1
 
+        # The node last found to hold the least recently used item. See
+        # lrunode().
+        self.lruHint = None
+
         # Now that the invariant mentioned above is met, we can call size()
         # to adjust the list to the desired size.
         self.size(size)
@@ -181,11 +196,33 @@ class lrucache:
 
         return default
 
-    def popitem(self):
+    # Removes and returns the most recently used (key, value) pair, or the
+    # least recently used one if 'last' is false.
+    def popitem(self, last=True):
         # Make sure the cache isn't empty.
         if len(self) < 1:
             raise KeyError
 
+        if not last:
+            node = self.lrunode()
+            key = node.key
+            value = node.value
+
+            # The node is directly followed by the empty nodes, or by the
+            # 'head' node if there are none, so it is left in place. Once
+            # empty it becomes the first of the empty nodes, and the node
+            # before it holds the least recently used item.
+            del self.table[key]
+            node.empty = True
+            node.key = None
+            node.value = None
+
+            if node is self.head:
+                self.head = node.next
+            self.lruHint = node.prev
+
+            return key, value
+
         node = self.head
 
         # Save the key and value so that we can return them.
@@ -216,6 +253,45 @@ class lrucache:
         self[key] = default
         return default
 
+    # Moves 'key' to the most recently used position, or to the least
+    # recently used position if 'last' is false, without looking up its
+    # value.
+    def move_to_end(self, key, last=True):
+        node = self.table[key]
+
+        if last:
+            self.mtf(node)
+            self.head = node
+            return
+
+        lru = self.lrunode()
+        if node is lru:
+            return
+
+        if node is self.head:
+            self.head = node.next
+
+        # Splice the node out of the list, then back in directly after the
+        # least recently used node, ahead of any empty nodes.
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+        node.prev = lru
+        node.next = lru.next
+        lru.next.prev = node
+        lru.next = node
+
+        self.lruHint = node
+
+    # Returns the least recently used (key, value) pair without affecting the
+    # cache's order.
+    def peek_lru(self):
+        if len(self) < 1:
+            raise KeyError
+
+        node = self.lrunode()
+        return (node.key, node.value)
+
     def __iter__(self):
         # Return an iterator that returns the keys in the cache in order from
         # the most recently to least recently used. Does not modify the cache's
@@ -244,6 +320,22 @@ class lrucache:
         for node in self.dli():
             yield node.value
 
+    def iter_lru(self, n=None):
+        # Return an iterator that returns up to 'n' (key, value) pairs (all
+        # of them if 'n' is None) in order from the least recently to most
+        # recently used. Does not modify the cache's order.
+        count = len(self.table)
+        if n is not None:
+            count = min(n, count)
+
+        if count < 1:
+            return
+
+        node = self.lrunode()
+        for i in range(count):
+            yield (node.key, node.value)
+            node = node.prev
+
     def size(self, size=None):
         if size is not None:
             assert size > 0
@@ -304,6 +396,39 @@ class lrucache:
         node.next.prev = node
         node.prev.next = node
 
+    # This method returns the node holding the least recently used item. The
+    # cache must not be empty. The empty nodes are always between that node
+    # and the 'head' node, so it is the only non-empty node followed by an
+    # empty node or by the 'head' node. That makes it cheap to check whether
+    # the node found last time is still the right one. The methods that
+    # work on the least recently used end of the list keep 'lruHint' up to
+    # date, so taking items from that end one at a time does not search.
+    #
+    # Otherwise, if the cache is full that node is the tail of the list. If
+    # not, either the empty nodes are skipped going backwards from the 'head'
+    # node, or the non-empty nodes are skipped going forwards from it,
+    # whichever is fewer.
+    def lrunode(self):
+        node = self.lruHint
+        if node is not None and not node.empty and node.next is not None:
+            if node.next is self.head or node.next.empty:
+                return node
+
+        used = len(self.table)
+        unused = self.listSize - used
+
+        if unused < used:
+            node = self.head.prev
+            for i in range(unused):
+                node = node.prev
+        else:
+            node = self.head
+            for i in range(used - 1):
+                node = node.next
+
+        self.lruHint = node
+        return node
+
     # This method returns an iterator that iterates over the non-empty nodes
     # in the doubly linked list in order from the most recently to the least
     # recently used.
@@ -324,6 +449,12 @@ class lrucache:
         # Remove those that we need to do by hand.
         del d['table']
         del d['head']
+        del d['lruHint']
+
+        # Observers are not copied.
+        d.pop('observers', None)
+        d.pop('tick', None)
+        d.pop('stamps', None)
 
         # Package up the key/value pairs from the doubly linked list into a
         # normal list that can be copied/pickled correctly. We put the
@@ -357,6 +488,7 @@ class lrucache:
         self.head.prev = self.head
 
         self.listSize = 1
+        self.lruHint = None
 
         # Now adjust the list to the desired size.
         self.size(size)
@@ -368,12 +500,977 @@ class lrucache:
         for key, value in reversed(elements):
             self[key] = value
 
+    # Attaches an observer to the cache. The observer's methods are called
+    # when items are looked up, inserted, updated and ejected, and when the
+    # cache is resized or cleared. See lruobserver. Caches with no observers
+    # attached do not pay for them. The first observer changes the class of
+    # the cache to one that notifies observers, and removing the last one
+    # changes it back.
+    def addobserver(self, observer):
+        if not isinstance(self, _observedmixin):
+            self.observers = []
+
+            # The age of an item is measured in operations on the cache, so
+            # each node is stamped with the count of operations at its last
+            # use. The stamps are kept apart from the nodes, so that caches
+            # without observers do not pay for them. Items already in the
+            # cache are treated as having just been used.
+            self.tick = 0
+            self.stamps = {}
+
+            self.__class__ = _observedclass(type(self))
+
+        self.observers.append(observer)
+
+    def removeobserver(self, observer):
+        if not isinstance(self, _observedmixin):
+            raise ValueError
+
+        self.observers.remove(observer)
+        if not self.observers:
+            del self.observers
+            del self.tick
+            del self.stamps
+            self.__class__ = self.unobservedclass
+
+
+# Base class for the observers of an lrucache. Subclasses override the
+# methods for the events they are interested in.
+class lruobserver:
+    # A lookup found 'key' in the cache.
+    def hit(self, key):
+        pass
+
+    # A lookup did not find 'key' in the cache.
+    def miss(self, key):
+        pass
+
+    # A key/value pair was added to the cache.
+    def insert(self, key, value):
+        pass
+
+    # The value of a key already in the cache was replaced.
+    def update(self, key, value):
+        pass
+
+    # A key/value pair is about to be ejected from the cache. 'age' is the
+    # number of lookups and insertions made in the cache since the key was
+    # last used.
+    def evict(self, key, value, age):
+        pass
+
+    # The size of the cache changed.
+    def resize(self, oldsize, newsize):
+        pass
+
+    # The cache was cleared.
+    def clear(self):
+        pass
+
+
+# The methods of an lrucache that notify its observers. Rather than having
+# every method of lrucache check for observers, the class of an lrucache with
+# observers is changed to a subclass that also inherits from this one. See
+# lrucache.addobserver().
+class _observedmixin:
+    def clear(self):
+        super().clear()
+        for observer in self.observers:
+            observer.clear()
+
+    def __getitem__(self, key):
+        try:
+            value = super().__getitem__(key)
+        except KeyError:
+            for observer in self.observers:
+                observer.miss(key)
+            raise
+
+        self.tick += 1
+        self.stamps[self.head] = self.tick
+        for observer in self.observers:
+            observer.hit(key)
+
+        return value
+
+    def get(self, key, default=None):
+        if key not in self.table:
+            for observer in self.observers:
+                observer.miss(key)
+            return default
+
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self.tick += 1
+
+        if key in self.table:
+            super().__setitem__(key, value)
+            self.stamps[self.head] = self.tick
+            for observer in self.observers:
+                observer.update(key, value)
+            return
+
+        # The tail node is about to be reused. If it holds an item, that item
+        # is ejected.
+        node = self.head.prev
+        if not node.empty:
+            self.ejecting(node)
+
+        super().__setitem__(key, value)
+        self.stamps[self.head] = self.tick
+        for observer in self.observers:
+            observer.insert(key, value)
+
+    def size(self, size=None):
+        oldsize = self.listSize
+        if size is not None and size < oldsize:
+            # Shrinking the cache ejects the items in the nodes removed from
+            # the tail of the list.
+            node = self.head.prev
+            for i in range(oldsize - size):
+                if not node.empty:
+                    self.ejecting(node)
+                self.stamps.pop(node, None)
+                node = node.prev
+
+        newsize = super().size(size)
+        if newsize != oldsize:
+            for observer in self.observers:
+                observer.resize(oldsize, newsize)
+
+        return newsize
+
+    def ejecting(self, node):
+        age = self.tick - self.stamps.get(node, 0)
+        for observer in self.observers:
+            observer.evict(node.key, node.value, age)
+
+    # Copies and pickles are made of the unobserved class.
+    def __reduce_ex__(self, protocol):
+        return (object.__new__, (self.unobservedclass,),
+                self.__getstate__())
+
+
+_observedclasses = {}
+
+# Returns the observed version of an lrucache class.
+def _observedclass(cls):
+    if cls not in _observedclasses:
+        _observedclasses[cls] = type(cls.__name__, (_observedmixin, cls),
+                                     {'unobservedclass': cls})
+
+    return _observedclasses[cls]
+
+
+# An observer that keeps bounded statistics about a cache: counts of each
+# event, an estimate of the most frequently looked up keys, and a histogram
+# of the ages of ejected items.
+#
+# Only one in every 'every' lookups is sampled to estimate the most frequently
+# looked up keys. At most 'capacity' keys are tracked, using the Space-Saving
+# algorithm: when a new key is sampled and no room is left, it replaces the
+# key with the lowest count and inherits that count plus one. The keys are
+# kept in buckets by count, so this takes constant time. The counts are
+# therefore overestimates, but keys looked up more often than once in every
+# 'capacity' samples are always tracked.
+#
+# The ages of ejected items are counted in buckets of powers of two.
+class samplingobserver(lruobserver):
+    def __init__(self, capacity=100, every=1):
+        self.capacity = capacity
+        self.every = every
+        self.countdown = every
+
+        # The Space-Saving counts, by key, and the keys with each count, so
+        # that a key with the lowest count can be found without a search.
+        self.counts = {}
+        self.buckets = {}
+        self.mincount = 0
+        self.ages = []
+
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.updates = 0
+        self.evictions = 0
+        self.resizes = 0
+        self.clears = 0
+
+    def hit(self, key):
+        self.hits += 1
+        self.sample(key)
+
+    def miss(self, key):
+        self.misses += 1
+        self.sample(key)
+
+    def insert(self, key, value):
+        self.inserts += 1
+
+    def update(self, key, value):
+        self.updates += 1
+
+    def evict(self, key, value, age):
+        self.evictions += 1
+
+        bucket = age.bit_length()
+        while len(self.ages) <= bucket:
+            self.ages.append(0)
+        self.ages[bucket] += 1
+
+    def resize(self, oldsize, newsize):
+        self.resizes += 1
+
+    def clear(self):
+        self.clears += 1
+
+    def sample(self, key):
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.every
+
+        counts = self.counts
+        if key in counts:
+            count = counts[key]
+            self.unbucket(key, count)
+        elif len(counts) < self.capacity:
+            count = 0
+            self.mincount = 1
+        else:
+            count = self.mincount
+            victim = next(iter(self.buckets[count]))
+            self.unbucket(victim, count)
+            del counts[victim]
+
+        count += 1
+        counts[key] = count
+        if count in self.buckets:
+            self.buckets[count][key] = None
+        else:
+            self.buckets[count] = {key: None}
+
+    # Removes 'key' from the bucket of keys with 'count' samples. If that was
+    # the last of the keys with the lowest count, the lowest count is now one
+    # more, as the key is about to be counted again.
+    def unbucket(self, key, count):
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if count == self.mincount:
+                self.mincount = count + 1
+
+    # Returns a list of up to 'k' (key, count) pairs for the most frequently
+    # looked up keys, most frequent first. The counts are of samples, so
+    # multiply them by 'every' to estimate the number of lookups.
+    def hottest(self, k=10):
+        return heapq.nlargest(k, self.counts.items(), key=lambda x: x[1])
+
+    # Returns a list of (lowest age, count) pairs, one for each bucket of the
+    # histogram of ejected item ages. Each bucket counts the ages from its
+    # lowest age up to the lowest age of the next bucket.
+    def agehistogram(self):
+        return [(0 if i == 0 else 1 << (i - 1), count)
+                for i, count in enumerate(self.ages)]
+
+
+# Class for the entry objects used by gdsfcache.
+class _gdsfentry:
+    __slots__ = ('key', 'value', 'cost', 'nbytes', 'freq', 'heapitem')
+
+
+# Cache implementation with a GreedyDual-Size-Frequency (GDSF) replacement
+# policy. Each entry is given a priority of
+#
+#     L + freq * cost / nbytes
+#
+# where 'cost' is what it takes to recreate the entry (for example the time it
+# took to compute it), 'nbytes' is its size, 'freq' is the number of times it
+# has been used, and 'L' is an inflation value. When the cache is full the
+# entry with the lowest priority is ejected and 'L' is raised to that
+# entry's priority. Entries that are not used therefore age relative to newly
+# inserted or recently used ones, while cheap to recreate entries are ejected
+# before expensive ones. With the default cost and size of one the policy
+# behaves like LFU with aging.
+#
+# The priorities are kept in a binary heap. Changing an entry's priority
+# pushes a new heap item and marks the old one as removed, rather than
+# searching the heap for it. Removed items are skipped when they reach the top
+# of the heap, and the heap is rebuilt when they start to dominate it.
+class gdsfcache:
+    def __init__(self, size, callback=None):
+        self.callback = callback
+
+        self.table = {}
+        self.heap = []
+
+        # The inflation value 'L'.
+        self.inflation = 0.0
+
+        # Sequence number used to break ties between equal priorities, so
+        # that among them the least recently used entry is ejected first.
+        self.counter = 0
+
+        self.maxSize = 1
+        self.size(size)
+
+    def __len__(self):
+        return len(self.table)
+
+    def clear(self):
+        self.table.clear()
+        self.heap = []
+        self.inflation = 0.0
+
+    def __contains__(self, key):
+        return key in self.table
+
+    # Looks up a value in the cache without affecting the entry's priority.
+    def peek(self, key):
+        entry = self.table[key]
+        return entry.value
+
+    def __getitem__(self, key):
+        entry = self.table[key]
+        entry.freq += 1
+        self.prioritize(entry)
+        return entry.value
+
+    def get(self, key, default=None):
+        if key not in self.table:
+            return default
+
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self.insert(key, value)
+
+    # Inserts a key/value pair along with the cost of recreating it and its
+    # size. Both must be positive numbers, in whatever units are convenient,
+    # as long as they are used consistently.
+    def insert(self, key, value, cost=1, size=1):
+        assert size > 0
+
+        # Replacing the value of an existing entry counts as a use of it.
+        if key in self.table:
+            entry = self.table[key]
+            entry.value = value
+            entry.cost = cost
+            entry.nbytes = size
+            entry.freq += 1
+            self.prioritize(entry)
+            return
+
+        if len(self.table) >= self.maxSize:
+            self.eject()
+
+        entry = _gdsfentry()
+        entry.key = key
+        entry.value = value
+        entry.cost = cost
+        entry.nbytes = size
+        entry.freq = 1
+        entry.heapitem = None
+
+        self.table[key] = entry
+        self.prioritize(entry)
+
+    def __delitem__(self, key):
+        entry = self.table.pop(key)
+        entry.heapitem[2] = None
+
+    __defaultObj = object()
+    def pop(self, key, default=__defaultObj):
+        if key in self.table:
+            value = self.peek(key)
+            del self[key]
+            return value
+
+        if default is self.__defaultObj:
+            raise KeyError
+
+        return default
+
+    # Removes and returns the (key, value) pair with the lowest priority, the
+    # one that would be ejected next.
+    def popitem(self):
+        if len(self) < 1:
+            raise KeyError
+
+        entry = self.popentry()
+        return entry.key, entry.value
+
+    def setdefault(self, key, default=None):
+        if key in self.table:
+            return self[key]
+
+        self[key] = default
+        return default
+
+    update = lrucache.update
+
+    def __iter__(self):
+        # Return an iterator that returns the keys in the cache in arbitrary
+        # order. Does not modify any priorities.
+        return iter(list(self.table))
+
+    def items(self):
+        for entry in list(self.table.values()):
+            yield (entry.key, entry.value)
+
+    def keys(self):
+        return iter(list(self.table))
+
+    def values(self):
+        for entry in list(self.table.values()):
+            yield entry.value
+
+    def size(self, size=None):
+        if size is not None:
+            assert size > 0
+            self.maxSize = size
+            while len(self.table) > size:
+                self.eject()
+
+        return self.maxSize
+
+    # Computes the priority of 'entry' and pushes a heap item for it,
+    # invalidating the item previously pushed for it, if any.
+    def prioritize(self, entry):
+        if entry.heapitem is not None:
+            entry.heapitem[2] = None
+
+        priority = self.inflation + entry.freq * entry.cost / entry.nbytes
+        self.counter += 1
+        item = [priority, self.counter, entry]
+        entry.heapitem = item
+        heapq.heappush(self.heap, item)
+
+        # If most of the heap consists of removed items, rebuild it from the
+        # live ones.
+        if len(self.heap) > 2 * len(self.table) + 16:
+            self.heap = [entry.heapitem for entry in self.table.values()]
+            heapq.heapify(self.heap)
+
+    # Ejects the entry with the lowest priority.
+    def eject(self):
+        entry = self.popentry()
+        if self.callback is not None:
+            self.callback(entry.key, entry.value)
+
+    # Removes the entry with the lowest priority from the cache and returns
+    # it. Raises the inflation value to its priority.
+    def popentry(self):
+        while True:
+            priority, counter, entry = heapq.heappop(self.heap)
+            if entry is not None:
+                break
+
+        self.inflation = priority
+        del self.table[entry.key]
+        return entry
+
+    # See lrucache.__getstate__(). The heap items reference the entries, so
+    # the state is packaged up as a simple list instead.
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        del d['table']
+        del d['heap']
+
+        elements = [(entry.key, entry.value, entry.cost, entry.nbytes,
+                     entry.freq, entry.heapitem[0], entry.heapitem[1])
+                    for entry in self.table.values()]
+        return (d, elements)
+
+    def __setstate__(self, state):
+        d = state[0]
+        elements = state[1]
+
+        self.__dict__.update(d)
+        self.table = {}
+        self.heap = []
+
+        for key, value, cost, nbytes, freq, priority, counter in elements:
+            entry = _gdsfentry()
+            entry.key = key
+            entry.value = value
+            entry.cost = cost
+            entry.nbytes = nbytes
+            entry.freq = freq
+            entry.heapitem = [priority, counter, entry]
+            self.table[key] = entry
+            self.heap.append(entry.heapitem)
+
+        heapq.heapify(self.heap)
+
+
+# Class for the segment file objects used by disklrucache.
+class _segment:
+    __slots__ = ('path', 'live', 'total')
+
+
+# Callback of the lrucache holding a disklrucache's open segment files. It is
+# not a method, so that the files do not keep the disklrucache alive.
+def _closefile(segmentid, f):
+    f.close()
+
+
+# Closes the open segment files of a disklrucache and removes its directory.
+# Called by close(), or by the garbage collector or at exit if close() was
+# never called.
+def _removesegments(files, directory):
+    for f in files.values():
+        f.close()
+    files.clear()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+# Cache implementation with an LRU replacement policy that keeps its values on
+# disk. The key/value pairs are pickled and appended to segment files. When
+# the active segment grows past 'segmentsize' bytes a new one is started.
+# An lrucache maps each key to the location of its record, so the index (and
+# therefore the LRU order) is kept in memory, while the values are not.
+# Replacing or removing a key leaves its old record behind as garbage. Segment
+# files that no longer hold any live records are removed, and when the
+# garbage outweighs the live records the remaining live records are copied out
+# of mostly dead segments by compact().
+#
+# The index is not saved, so the contents of the cache do not survive the
+# process. Each cache keeps its segment files in a subdirectory of its own,
+# created in 'directory' (or in the system's temporary directory if none is
+# given), so several caches can share a directory. close() removes the
+# subdirectory. If the cache is not closed, the subdirectory is removed when
+# the cache is garbage collected or the process exits. At most 'maxopen'
+# segment files are kept open at a time.
+class disklrucache:
+    def __init__(self, size, directory=None, callback=None,
+                 segmentsize=16*1024*1024, maxopen=16):
+        self.callback = callback
+        self.segmentsize = segmentsize
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='pylru-', dir=directory)
+
+        # The open segment files, by segment id. Files pushed out of it are
+        # closed, and opened again when they are next needed.
+        self.files = lrucache(maxopen, _closefile)
+        self.finalizer = weakref.finalize(self, _removesegments, self.files,
+                                          self.directory)
+
+        # The index maps each key to a [segment id, offset, length] list. The
+        # lists are updated in place by compact(), so that moving a record
+        # does not affect the LRU order.
+        self.index = lrucache(size, self.ejected)
+
+        self.segments = {}
+        self.nextSegment = 0
+        self.liveBytes = 0
+        self.deadBytes = 0
+        self.roll()
+
+    def __len__(self):
+        return len(self.index)
+
+    def clear(self):
+        self.index.clear()
+        self.closefiles()
+        for segment in self.segments.values():
+            os.remove(segment.path)
+
+        self.segments = {}
+        self.liveBytes = 0
+        self.deadBytes = 0
+        self.roll()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    # Looks up a value in the cache without affecting the cache's order.
+    def peek(self, key):
+        return self.read(self.index.peek(key))[1]
+
+    def __getitem__(self, key):
+        return self.read(self.index[key])[1]
+
+    def get(self, key, default=None):
+        if key not in self.index:
+            return default
+
+        return self[key]
+
+    def __setitem__(self, key, value):
+        location = self.write(pickle.dumps((key, value),
+                                           pickle.HIGHEST_PROTOCOL))
+        if key in self.index:
+            old = self.index.peek(key)
+            self.index[key] = location
+            self.release(old)
+        else:
+            self.index[key] = location
+
+        self.maybeCompact()
+
+    def __delitem__(self, key):
+        location = self.index.peek(key)
+        del self.index[key]
+        self.release(location)
+        self.maybeCompact()
+
+    update = lrucache.update
+
+    __defaultObj = object()
+    def pop(self, key, default=__defaultObj):
+        if key in self.index:
+            location = self.index.peek(key)
+            value = self.read(location)[1]
+            del self.index[key]
+            self.release(location)
+            self.maybeCompact()
+            return value
+
+        if default is self.__defaultObj:
+            raise KeyError
+
+        return default
+
+    def popitem(self, last=True):
+        key, location = self.index.popitem(last)
+        item = self.read(location)
+        self.release(location)
+        self.maybeCompact()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self.index:
+            return self[key]
+
+        self[key] = default
+        return default
+
+    def __iter__(self):
+        return self.index.keys()
+
+    def items(self):
+        # Return an iterator that returns the (key, value) pairs in the cache
+        # in order from the most recently to least recently used. Does not
+        # modify the cache's order.
+        for location in self.index.values():
+            yield self.read(location)
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        for location in self.index.values():
+            yield self.read(location)[1]
+
+    def size(self, size=None):
+        size = self.index.size(size)
+        self.maybeCompact()
+        return size
+
+    # Closes and removes the segment files, along with the cache's
+    # directory.
+    def close(self):
+        self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    # Called by the index when a key is ejected. The key is still in the
+    # index at this point, so compaction must wait until the index is
+    # consistent again.
+    def ejected(self, key, location):
+        if self.callback is not None:
+            self.callback(*self.read(location))
+        self.release(location)
+
+    # Starts a new active segment.
+    def roll(self):
+        segment = _segment()
+        segment.path = os.path.join(self.directory,
+                                    'segment-%08d' % self.nextSegment)
+        segment.live = 0
+        segment.total = 0
+
+        self.active = self.nextSegment
+        self.segments[self.active] = segment
+        self.files[self.active] = open(segment.path, 'w+b')
+        self.nextSegment += 1
+
+    # Returns the open file of a segment, opening it if necessary.
+    def file(self, segmentid):
+        if segmentid in self.files:
+            return self.files[segmentid]
+
+        f = open(self.segments[segmentid].path, 'r+b')
+        self.files[segmentid] = f
+        return f
+
+    def closefiles(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    # Appends a record to the active segment and returns its location.
+    def write(self, data):
+        segment = self.segments[self.active]
+        if segment.total >= self.segmentsize:
+            self.roll()
+            segment = self.segments[self.active]
+
+        f = self.file(self.active)
+        f.seek(segment.total)
+        f.write(data)
+
+        location = [self.active, segment.total, len(data)]
+        segment.live += len(data)
+        segment.total += len(data)
+        self.liveBytes += len(data)
+        return location
+
+    def readraw(self, location):
+        f = self.file(location[0])
+        f.seek(location[1])
+        return f.read(location[2])
+
+    def read(self, location):
+        return pickle.loads(self.readraw(location))
+
+    # Marks the record at 'location' as garbage.
+    def release(self, location):
+        segment = self.segments[location[0]]
+        segment.live -= location[2]
+        self.liveBytes -= location[2]
+        self.deadBytes += location[2]
+
+        if segment.live == 0 and location[0] != self.active:
+            self.removeSegment(location[0])
+
+    def maybeCompact(self):
+        if self.deadBytes > max(self.liveBytes, self.segmentsize):
+            self.compact()
+
+    def removeSegment(self, segmentid):
+        segment = self.segments.pop(segmentid)
+        if segmentid in self.files:
+            self.files.pop(segmentid).close()
+        os.remove(segment.path)
+        self.deadBytes -= segment.total - segment.live
+
+    # Copies the live records out of the segments that are at least half
+    # garbage, then removes those segments.
+    def compact(self):
+        victims = set(segmentid for segmentid, segment in self.segments.items()
+                      if segment.live * 2 <= segment.total)
+        if not victims:
+            return
+
+        if self.active in victims:
+            self.roll()
+
+        for location in self.index.values():
+            if location[0] in victims:
+                data = self.readraw(location)
+                self.liveBytes -= location[2]
+                location[:] = self.write(data)
+
+        for segmentid in victims:
+            self.removeSegment(segmentid)
+
+
+# A two tier cache. The most recently used items are kept in an lrucache in
+# memory. Items ejected from it are spilled to a disklrucache rather than
+# being discarded, and are promoted back to memory when they are looked up.
+# The two tiers hold disjoint sets of keys, so together they behave like an
+# LRU cache of size 'size' + 'disksize'. The callback, if given, is called
+# when an item is ejected from the disk tier.
+class tieredcache:
+    def __init__(self, size, disksize, directory=None, callback=None,
+                 segmentsize=16*1024*1024, maxopen=16):
+        self.disk = disklrucache(disksize, directory, callback, segmentsize,
+                                 maxopen)
+
+        def spill(key, value):
+            self.disk[key] = value
+
+        self.memory = lrucache(size, spill)
+
+    def __len__(self):
+        return len(self.memory) + len(self.disk)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.disk
+
+    # Looks up a value in the cache without affecting the cache's order.
+    def peek(self, key):
+        if key in self.memory:
+            return self.memory.peek(key)
+
+        return self.disk.peek(key)
+
+    def __getitem__(self, key):
+        if key in self.memory:
+            return self.memory[key]
+
+        # Promote the item from disk to memory. This may spill the least
+        # recently used item in memory to disk.
+        value = self.disk.pop(key)
+        self.memory[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+
+        return self[key]
+
+    def __setitem__(self, key, value):
+        if key in self.disk:
+            del self.disk[key]
+
+        self.memory[key] = value
+
+    def __delitem__(self, key):
+        if key in self.memory:
+            del self.memory[key]
+        else:
+            del self.disk[key]
+
+    update = lrucache.update
+
+    __defaultObj = object()
+    def pop(self, key, default=__defaultObj):
+        if key in self:
+            value = self.peek(key)
+            del self[key]
+            return value
+
+        if default is self.__defaultObj:
+            raise KeyError
+
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        self[key] = default
+        return default
+
+    # Removes and returns the most recently used item, which is in memory
+    # unless the memory tier is empty, or the least recently used item if
+    # 'last' is false, which is on disk unless the disk tier is empty.
+    def popitem(self, last=True):
+        if len(self) < 1:
+            raise KeyError
+
+        if last:
+            tiers = (self.memory, self.disk)
+        else:
+            tiers = (self.disk, self.memory)
+
+        for tier in tiers:
+            if len(tier) > 0:
+                return tier.popitem(last)
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self):
+        # Return an iterator that returns the (key, value) pairs in the cache
+        # in order from the most recently to least recently used, memory
+        # first. Does not modify the cache's order.
+        yield from self.memory.items()
+        yield from self.disk.items()
+
+    def keys(self):
+        yield from self.memory.keys()
+        yield from self.disk.keys()
+
+    def values(self):
+        yield from self.memory.values()
+        yield from self.disk.values()
+
+    # Returns/sets the size of the memory tier. Items ejected by shrinking it
+    # are spilled to disk.
+    def size(self, size=None):
+        return self.memory.size(size)
+
+    # Returns/sets the size of the disk tier.
+    def disksize(self, size=None):
+        return self.disk.size(size)
+
+    def close(self):
+        self.disk.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+# A bounded set of keys known to be missing from a store, used by the cache
+# managers for negative caching. The least recently used keys are forgotten
+# first. If a ttl is given, keys are also forgotten 'ttl' seconds after they
+# were added, so that keys added to the store behind the manager's back are
+# eventually found.
+class _negativecache:
+    def __init__(self, size, ttl=None):
+        self.ttl = ttl
+        self.cache = lrucache(size)
+
+    def __contains__(self, key):
+        if key not in self.cache:
+            return False
+
+        expires = self.cache[key]
+        if expires is not None and expires <= time.monotonic():
+            del self.cache[key]
+            return False
+
+        return True
+
+    def add(self, key):
+        if self.ttl is None:
+            self.cache[key] = None
+        else:
+            self.cache[key] = time.monotonic() + self.ttl
+
+    def discard(self, key):
+        self.cache.pop(key, None)
+
+    def clear(self):
+        self.cache.clear()
+
 
 class WriteThroughCacheManager:
-    def __init__(self, store, size):
+    # If 'negsize' is given, up to that many keys that were found to be
+    # missing from the store are remembered, so that looking them up again
+    # does not go to the store. If 'negttl' is also given they are only
+    # remembered for that many seconds.
+    def __init__(self, store, size, negsize=None, negttl=None):
         self.store = store
         self.cache = lrucache(size)
 
+        if negsize is None:
+            self.negative = None
+        else:
+            self.negative = _negativecache(negsize, negttl)
+
     def __len__(self):
         return len(self.store)
 
@@ -384,16 +1481,26 @@ class WriteThroughCacheManager:
     def clear(self):
         self.cache.clear()
         self.store.clear()
+        if self.negative is not None:
+            self.negative.clear()
 
     def __contains__(self, key):
         # Check the cache first. If it is there we can return quickly.
         if key in self.cache:
             return True
 
-        # Not in the cache. Might be in the underlying store.
+        # Not in the cache. If we know it is not in the store either, we can
+        # also return quickly.
+        if self.negative is not None and key in self.negative:
+            return False
+
+        # Might be in the underlying store.
         if key in self.store:
             return True
 
+        if self.negative is not None:
+            self.negative.add(key)
+
         return False
 
     def __getitem__(self, key):
@@ -401,9 +1508,20 @@ class WriteThroughCacheManager:
         if key in self.cache:
             return self.cache[key]
 
-        # It wasn't in the cache. Look it up in the store, add the entry to
-        # the cache, and return the value.
-        value = self.store[key]
+        # It wasn't in the cache. If we know it is not in the store either,
+        # there is no need to look.
+        if self.negative is not None and key in self.negative:
+            raise KeyError
+
+        # Look it up in the store, add the entry to the cache, and return the
+        # value. Remember the key if the store does not have it.
+        try:
+            value = self.store[key]
+        except KeyError:
+            if self.negative is not None:
+                self.negative.add(key)
+            raise
+
         self.cache[key] = value
         return value
 
@@ -417,6 +1535,8 @@ class WriteThroughCacheManager:
         # Add the key/value pair to the cache and store.
         self.cache[key] = value
         self.store[key] = value
+        if self.negative is not None:
+            self.negative.discard(key)
 
     def __delitem__(self, key):
         # With write-through behavior the cache and store should be consistent.
@@ -430,6 +1550,9 @@ class WriteThroughCacheManager:
         except KeyError:
             pass
 
+        if self.negative is not None:
+            self.negative.add(key)
+
     def __iter__(self):
         return self.keys()
 
@@ -444,9 +1567,15 @@ class WriteThroughCacheManager:
 
 
 class WriteBackCacheManager:
-    def __init__(self, store, size):
+    # See WriteThroughCacheManager for 'negsize' and 'negttl'.
+    def __init__(self, store, size, negsize=None, negttl=None):
         self.store = store
 
+        if negsize is None:
+            self.negative = None
+        else:
+            self.negative = _negativecache(negsize, negttl)
+
         # Create a set to hold the dirty keys.
         self.dirty = set()
 
@@ -474,16 +1603,26 @@ class WriteBackCacheManager:
         self.cache.clear()
         self.dirty.clear()
         self.store.clear()
+        if self.negative is not None:
+            self.negative.clear()
 
     def __contains__(self, key):
         # Check the cache first, since if it is there we can return quickly.
         if key in self.cache:
             return True
 
-        # Not in the cache. Might be in the underlying store.
+        # Not in the cache. If we know it is not in the store either, we can
+        # also return quickly.
+        if self.negative is not None and key in self.negative:
+            return False
+
+        # Might be in the underlying store.
         if key in self.store:
             return True
 
+        if self.negative is not None:
+            self.negative.add(key)
+
         return False
 
     def __getitem__(self, key):
@@ -491,9 +1630,20 @@ class WriteBackCacheManager:
         if key in self.cache:
             return self.cache[key]
 
-        # It wasn't in the cache. Look it up in the store, add the entry to
-        # the cache, and return the value.
-        value = self.store[key]
+        # It wasn't in the cache. If we know it is not in the store either,
+        # there is no need to look.
+        if self.negative is not None and key in self.negative:
+            raise KeyError
+
+        # Look it up in the store, add the entry to the cache, and return the
+        # value. Remember the key if the store does not have it.
+        try:
+            value = self.store[key]
+        except KeyError:
+            if self.negative is not None:
+                self.negative.add(key)
+            raise
+
         self.cache[key] = value
         return value
 
@@ -507,6 +1657,8 @@ class WriteBackCacheManager:
         # Add the key/value pair to the cache.
         self.cache[key] = value
         self.dirty.add(key)
+        if self.negative is not None:
+            self.negative.discard(key)
 
     def __delitem__(self, key):
         found = False
@@ -523,6 +1675,9 @@ class WriteBackCacheManager:
         except KeyError:
             pass
 
+        if self.negative is not None:
+            self.negative.add(key)
+
         if not found:  # If not found in cache or store, raise error.
             raise KeyError
 
@@ -571,44 +1726,408 @@ class WriteBackCacheManager:
 
 
 class FunctionCacheManager:
-    def __init__(self, func, size, callback=None):
+    # If 'costaware' is true the results are kept in a gdsfcache rather than
+    # an lrucache. The cost of each result is the time it took to compute, so
+    # results that are cheap to recompute are ejected before expensive ones.
+    # The optional 'sizeof' function is called on each result to get its
+    # size, so that large results are ejected before small ones. Sizes below
+    # one are counted as one. The size of the cache is still the number of
+    # results it holds.
+    #
+    # If 'softttl' is given, results older than that many seconds are stale.
+    # A stale result is still returned, but a background thread is started
+    # to recompute it. At most 'refreshworkers' results are recomputed at a
+    # time, and a result is never recomputed by more than one thread at once.
+    # If a refresh can not be started right away, the next call for the
+    # result tries again. Results older than 'hardttl' seconds are recomputed
+    # before being returned, as if they were not in the cache. If a refresh
+    # raises an exception the stale result is kept until it reaches the hard
+    # ttl. If only 'hardttl' is given, results simply expire.
+    def __init__(self, func, size, callback=None, costaware=False,
+                 sizeof=None, softttl=None, hardttl=None, refreshworkers=1):
         self.func = func
-        self.cache = lrucache(size, callback)
+        self.costaware = costaware
+        self.sizeof = sizeof
+
+        if softttl is None:
+            softttl = hardttl
+        self.softttl = softttl
+        self.hardttl = hardttl
+        self.refreshworkers = refreshworkers
+
+        # The time each result was computed, the keys being refreshed, and
+        # the executor that refreshes them. The lock protects these and the
+        # cache from the refresh threads. It is reentrant because a
+        # CacheBudgetManager may call size() while the cache is being used.
+        self.loaded = {}
+        self.refreshing = set()
+        self.executor = None
+        self.lock = threading.RLock()
+
+        if softttl is not None:
+            userCallback = callback
+            def callback(key, value):
+                self.loaded.pop(key, None)
+                if userCallback is not None:
+                    userCallback(key, value)
+
+        if costaware:
+            self.cache = gdsfcache(size, callback)
+        else:
+            self.cache = lrucache(size, callback)
 
     def size(self, size=None):
-        return self.cache.size(size)
+        with self.lock:
+            return self.cache.size(size)
 
     def clear(self):
-        self.cache.clear()
+        with self.lock:
+            self.cache.clear()
+            self.loaded.clear()
 
     def __call__(self, *args, **kwargs):
         kwtuple = tuple((key, kwargs[key]) for key in sorted(kwargs.keys()))
         key = (args, kwtuple)
+
+        if self.softttl is not None:
+            return self.callttl(key, args, kwargs)
+
         try:
             return self.cache[key]
         except KeyError:
             pass
 
+        return self.load(key, args, kwargs)
+
+    # Computes the result for 'key' and adds it to the cache.
+    def load(self, key, args, kwargs):
+        if not self.costaware and self.softttl is None:
+            value = self.func(*args, **kwargs)
+            self.cache[key] = value
+            return value
+
+        start = time.perf_counter()
         value = self.func(*args, **kwargs)
-        self.cache[key] = value
+        cost = time.perf_counter() - start
+
+        if self.softttl is None:
+            self.insert(key, value, cost)
+            return value
+
+        with self.lock:
+            self.insert(key, value, cost)
+            self.loaded[key] = time.monotonic()
+
         return value
 
+    def insert(self, key, value, cost):
+        if not self.costaware:
+            self.cache[key] = value
+        elif self.sizeof is None:
+            self.cache.insert(key, value, cost)
+        else:
+            # Empty results have a size of zero, but every result takes up
+            # some space.
+            self.cache.insert(key, value, cost, max(self.sizeof(value), 1))
+
+    # The version of __call__() used when results expire.
+    def callttl(self, key, args, kwargs):
+        with self.lock:
+            try:
+                value = self.cache[key]
+                age = time.monotonic() - self.loaded[key]
+            except KeyError:
+                age = None
+
+        if age is None or (self.hardttl is not None and age >= self.hardttl):
+            return self.load(key, args, kwargs)
+
+        if age >= self.softttl:
+            self.refresh(key, args, kwargs)
+
+        return value
+
+    # Starts recomputing the result for 'key' in the background, unless it
+    # is already being recomputed or all the refresh workers are busy.
+    def refresh(self, key, args, kwargs):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            if len(self.refreshing) >= self.refreshworkers:
+                return
+
+            self.refreshing.add(key)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.refreshworkers)
+            executor = self.executor
+
+        # close() may shut the executor down before the refresh is submitted.
+        # The refresh is then skipped; the caller already has its result.
+        try:
+            executor.submit(self.refreshtask, key, args, kwargs)
+        except Exception:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def refreshtask(self, key, args, kwargs):
+        try:
+            self.load(key, args, kwargs)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    # Shuts down the refresh threads. If 'wait' is true, waits for the
+    # refreshes in progress to finish first. Refreshes started by later calls
+    # start new threads.
+    def close(self, wait=True):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+
+        if executor is not None:
+            executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+# Calls 'func' once for each (args, kwtuple) key in 'keys' and returns a list
+# of (True, result) or (False, exception) pairs, so that one call raising an
+# exception does not lose the results of the others. Runs in the worker
+# processes of a ParallelFunctionCacheManager.
+def _callbatch(func, keys):
+    results = []
+    for args, kwtuple in keys:
+        try:
+            results.append((True, func(*args, **dict(kwtuple))))
+        except Exception as e:
+            results.append((False, e))
+
+    return results
+
+
+# Like FunctionCacheManager, but results that are not in the cache are
+# computed in a pool of worker processes, so that CPU bound functions can use
+# more than one core. The cache itself is kept in the calling process. The
+# function and its arguments and results must be picklable, which means the
+# function must be defined at the top level of a module.
+#
+# If a result is already being computed, callers that want it wait for it
+# rather than computing it again. map() computes the results for many
+# arguments at once, sending them to the workers in batches of 'chunksize'.
+# If a call raises an exception, it is raised to the callers waiting for that
+# result, and the other results of its batch are still cached. The manager
+# can be called from more than one thread.
+class ParallelFunctionCacheManager:
+    def __init__(self, func, size, callback=None, maxworkers=None,
+                 chunksize=16):
+        self.func = func
+        self.maxworkers = maxworkers
+        self.chunksize = chunksize
+        self.cache = lrucache(size, callback)
+
+        # The futures of the results being computed, by key. The lock
+        # protects these, the cache and the executor. Work is sent to the
+        # executor without the lock held, since doing so may have to start
+        # the worker processes. The lock is reentrant because a
+        # CacheBudgetManager may call size() while the cache is being used.
+        self.inflight = {}
+        self.lock = threading.RLock()
+        self.executor = None
 
-def lruwrap(store, size, writeback=False):
+    def size(self, size=None):
+        with self.lock:
+            return self.cache.size(size)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def __call__(self, *args, **kwargs):
+        kwtuple = tuple((key, kwargs[key]) for key in sorted(kwargs.keys()))
+        key = (args, kwtuple)
+
+        with self.lock:
+            try:
+                return self.cache[key]
+            except KeyError:
+                pass
+
+            future = self.inflight.get(key)
+            if future is None:
+                futures = self.claim([key])
+                future = futures[0]
+                executor = self.executor
+            else:
+                futures = None
+
+        if futures is not None:
+            self.submit(executor, [key], futures)
+
+        return future.result()
+
+    # Returns a list of the results of calling the function with the
+    # arguments taken from each of the iterables in turn, like the builtin
+    # map(). The results that are not in the cache are computed in parallel
+    # and added to the cache.
+    def map(self, *iterables):
+        keys = [(args, ()) for args in zip(*iterables)]
+
+        results = {}
+        futures = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                if key in results or key in futures:
+                    continue
+
+                try:
+                    results[key] = self.cache[key]
+                    continue
+                except KeyError:
+                    pass
+
+                future = self.inflight.get(key)
+                if future is None:
+                    missing.append(key)
+                    futures[key] = None
+                else:
+                    futures[key] = future
+
+            claimed = self.claim(missing)
+            for key, future in zip(missing, claimed):
+                futures[key] = future
+            executor = self.executor
+
+        self.submit(executor, missing, claimed)
+
+        for key, future in futures.items():
+            results[key] = future.result()
+
+        return [results[key] for key in keys]
+
+    # Shuts down the worker processes.
+    def close(self):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+
+        if executor is not None:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    # Creates a future for the result of each key, and marks the keys as
+    # being computed. Must be called with the lock held.
+    def claim(self, keys):
+        futures = [Future() for key in keys]
+        for key, future in zip(keys, futures):
+            self.inflight[key] = future
+
+        if keys and self.executor is None:
+            self.executor = ProcessPoolExecutor(self.maxworkers)
+
+        return futures
+
+    # Sends the claimed keys to the workers of 'executor' in batches. Must be
+    # called without the lock held.
+    def submit(self, executor, keys, futures):
+        for i in range(0, len(keys), self.chunksize):
+            batch = keys[i:i + self.chunksize]
+            batchFutures = futures[i:i + self.chunksize]
+
+            try:
+                pending = executor.submit(_callbatch, self.func, batch)
+            except BaseException as e:
+                # Let down the callers waiting for the rest of the keys too.
+                self.fail(executor, keys[i:], futures[i:], e)
+                raise
+
+            def done(pending, batch=batch, batchFutures=batchFutures):
+                self.finish(executor, batch, batchFutures, pending)
+
+            pending.add_done_callback(done)
+
+    # Adds the results of a batch to the cache and passes them on to the
+    # callers waiting for them.
+    def finish(self, executor, batch, futures, pending):
+        try:
+            results = pending.result()
+        except BaseException as e:
+            self.fail(executor, batch, futures, e)
+            return
+
+        # Adding the results to the cache may raise, in the cache's callback
+        # or in a CacheBudgetManager's observer. The callers still get their
+        # results, and the keys are no longer marked as being computed.
+        try:
+            with self.lock:
+                for key in batch:
+                    del self.inflight[key]
+                for key, (ok, value) in zip(batch, results):
+                    if ok:
+                        self.cache[key] = value
+        finally:
+            for future, (ok, value) in zip(futures, results):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    # Raises 'e' to the callers waiting for the keys. If a worker process of
+    # 'executor' died, the executor cannot be used again, so it is dropped
+    # and the next call starts a new one.
+    def fail(self, executor, keys, futures, e):
+        with self.lock:
+            for key in keys:
+                del self.inflight[key]
+            if isinstance(e, BrokenProcessPool) and self.executor is executor:
+                self.executor = None
+
+        for future in futures:
+            future.set_exception(e)
+
+
+def lruwrap(store, size, writeback=False, negsize=None, negttl=None):
     if writeback:
-        return WriteBackCacheManager(store, size)
+        return WriteBackCacheManager(store, size, negsize, negttl)
     else:
-        return WriteThroughCacheManager(store, size)
+        return WriteThroughCacheManager(store, size, negsize, negttl)
 
 
 import functools
 
 class lrudecorator:
     # Ben doesn't like the MIT License, but he agreed to it anyway. Thanks Ben!
-    def __init__(self, size, callback=None):
-        self.cache = lrucache(size, callback)
+    #
+    # The arguments are the same as those of FunctionCacheManager. In the
+    # common case, without costaware or a ttl, the wrapper looks results up
+    # in the cache itself. Otherwise it calls a FunctionCacheManager, which is
+    # created here so that 'cache' is available before decorating.
+    def __init__(self, size, callback=None, costaware=False, sizeof=None,
+                 softttl=None, hardttl=None, refreshworkers=1):
+        if costaware or softttl is not None or hardttl is not None:
+            self.options = (size, callback, costaware, sizeof, softttl,
+                            hardttl, refreshworkers)
+            self.manager = FunctionCacheManager(None, *self.options)
+            self.cache = self.manager.cache
+        else:
+            self.manager = None
+            self.cache = lrucache(size, callback)
 
     def __call__(self, func):
+        if self.manager is not None:
+            return self.wrapmanager(func)
+
         def wrapper(*args, **kwargs):
             kwtuple = tuple((key, kwargs[key]) for key in sorted(kwargs.keys()))
             key = (args, kwtuple)
@@ -621,7 +2140,237 @@ class lrudecorator:
             self.cache[key] = value
             return value
 
+        # There are no threads to shut down, but decorated functions all
+        # have a close() method.
+        def close(wait=True):
+            pass
+
         wrapper.cache = self.cache
         wrapper.size = self.cache.size
         wrapper.clear = self.cache.clear
+        wrapper.close = close
+        return functools.update_wrapper(wrapper, func)
+
+    def wrapmanager(self, func):
+        manager = self.manager
+        if manager.func is None:
+            manager.func = func
+        else:
+            # The decorator was already used. The manager is bound to the
+            # function it was used on, so this function gets its own.
+            manager = FunctionCacheManager(func, *self.options)
+
+        def wrapper(*args, **kwargs):
+            return manager(*args, **kwargs)
+
+        wrapper.cache = manager.cache
+        wrapper.size = manager.size
+        wrapper.clear = manager.clear
+        wrapper.close = manager.close
         return functools.update_wrapper(wrapper, func)
+
+
+# The observer a CacheBudgetManager attaches to each cache it manages. Keys
+# ejected from the cache are remembered in a ghost cache of 'ghostsize' keys.
+# When a key is inserted again while still in the ghost cache, it would have
+# been a hit had the cache been 'ghostsize' entries larger. The number of
+# these ghost hits measures how much the cache would gain from growing.
+# 'owner' is the object that was registered, whose size() is used to resize
+# the cache. 'target' is the size the manager has given the cache. The cache
+# is resized to it on its next lookup or insertion, by the thread making it.
+class _budgetobserver(lruobserver):
+    def __init__(self, manager, owner, cache, ghostsize):
+        self.manager = manager
+        self.owner = owner
+        self.cache = cache
+        self.ghosts = lrucache(ghostsize)
+        self.target = cache.size()
+
+        self.hits = 0
+        self.misses = 0
+        self.ghosthits = 0
+
+    def hit(self, key):
+        self.hits += 1
+        self.manager.tick()
+        self.apply()
+
+    def insert(self, key, value):
+        # New keys are inserted after they were not found, so count them as
+        # misses.
+        self.misses += 1
+        if key in self.ghosts:
+            del self.ghosts[key]
+            self.ghosthits += 1
+        self.manager.tick()
+        self.apply()
+
+    def evict(self, key, value, age):
+        self.ghosts[key] = None
+
+    # Resizes the cache to the target size, if it changed.
+    def apply(self):
+        target = self.target
+        if target != self.cache.size():
+            self.owner.size(target)
+
+
+# Manages the sizes of a group of caches so that together they hold no more
+# than 'budget' entries. Every 'interval' lookups and insertions across the
+# caches, up to 'step' entries of capacity are moved from the caches that
+# would gain the least from being larger to the one that would gain the most,
+# as measured by the ghost hits of each cache since the last rebalance (see
+# _budgetobserver). Capacity that is not in use by any cache is handed out
+# first, and shrinking a cache ejects its least recently used items. Each
+# cache keeps a size of at least one.
+#
+# Caches are lrucache objects, or objects that keep one in a 'cache'
+# attribute, such as the cache managers and functions decorated with
+# lrudecorator (without costaware). The sizes of registered caches should
+# only be changed by the manager.
+#
+# Rebalancing happens in whichever thread makes the operation that reaches
+# the interval, which may be a refresh thread or a worker callback rather
+# than a thread using the other caches. So rebalancing only sets the size
+# each cache should have, and each cache is resized on its next lookup or
+# insertion, by the thread making it. Caches are resized through the size()
+# method of the registered object, so managers that lock their cache
+# (FunctionCacheManager, when results expire, and
+# ParallelFunctionCacheManager) are resized under their own lock. That lock
+# is already held by the thread using the cache, which is why these locks
+# are reentrant. Until all the caches have been used
+# after a rebalance, a cache that grew may have been resized before the ones
+# that shrank, so the caches can briefly hold more than the budget. A
+# rebalance that would have to wait for another thread's rebalance is
+# skipped.
+class CacheBudgetManager:
+    def __init__(self, budget, step=None, interval=1000):
+        assert budget > 0
+        if step is None:
+            step = max(1, budget // 100)
+
+        self.budget = budget
+        self.step = step
+        self.interval = interval
+        self.countdown = interval
+        self.members = []
+        self.lock = threading.RLock()
+
+    # Starts managing the size of 'cache'. If that puts the caches over the
+    # budget, they are shrunk to fit, starting with 'cache'. 'cache' is
+    # resized right away, so it should be registered by a thread using it.
+    # A cache can only be registered once.
+    def register(self, cache):
+        with self.lock:
+            owner = cache
+            cache = self.lrucacheof(owner)
+            if self.find(cache) is not None:
+                raise ValueError
+
+            observer = _budgetobserver(self, owner, cache, self.step)
+            cache.addobserver(observer)
+            self.members.append(observer)
+            self.shrink(self.members[::-1])
+            observer.apply()
+
+    # Stops managing the size of 'cache'. It keeps its current size.
+    def unregister(self, cache):
+        with self.lock:
+            observer = self.find(self.lrucacheof(cache))
+            if observer is None:
+                raise KeyError
+
+            observer.cache.removeobserver(observer)
+            self.members.remove(observer)
+
+    # Returns the total of the sizes given to the managed caches. Caches that
+    # have not been used since their size was changed may not have that size
+    # yet.
+    def total(self):
+        return sum(observer.target for observer in self.members)
+
+    # Returns a list of (cache, size, entries, hits, misses) tuples, one for
+    # each managed cache.
+    def stats(self):
+        return [(observer.cache, observer.cache.size(), len(observer.cache),
+                 observer.hits, observer.misses)
+                for observer in self.members]
+
+    def tick(self):
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+
+        # If another thread is rebalancing, it may be waiting for the lock of
+        # the cache this thread is using, so don't wait for it.
+        if not self.lock.acquire(False):
+            return
+
+        try:
+            self.countdown = self.interval
+            self.balance()
+        finally:
+            self.lock.release()
+
+    def rebalance(self):
+        with self.lock:
+            self.balance()
+
+    # Does the work of rebalance(). Must be called with the lock held.
+    def balance(self):
+        # Rank the caches from the least to the most valuable.
+        ranked = sorted(self.members, key=lambda x: x.ghosthits)
+        if not ranked:
+            return
+
+        self.shrink(ranked)
+
+        receiver = ranked[-1]
+        if receiver.ghosthits > 0:
+            grow = min(self.step, self.budget - self.total())
+            for donor in ranked:
+                if grow >= self.step:
+                    break
+                if donor.ghosthits >= receiver.ghosthits:
+                    break
+
+                take = min(self.step - grow, donor.target - 1)
+                if take > 0:
+                    donor.target -= take
+                    grow += take
+
+            if grow > 0:
+                receiver.target += grow
+
+        # Decay the ghost hits, so that the ranking follows changes in the
+        # access patterns.
+        for observer in ranked:
+            observer.ghosthits //= 2
+
+    # Shrinks the caches in the order given until they fit in the budget.
+    def shrink(self, ranked):
+        excess = self.total() - self.budget
+        for observer in ranked:
+            if excess <= 0:
+                break
+
+            take = min(excess, observer.target - 1)
+            if take > 0:
+                observer.target -= take
+                excess -= take
+
+    # Returns the observer of 'cache', or None if it is not registered.
+    def find(self, cache):
+        for observer in self.members:
+            if observer.cache is cache:
+                return observer
+
+        return None
+
+    def lrucacheof(self, cache):
+        if not isinstance(cache, lrucache):
+            cache = getattr(cache, 'cache', None)
+            if not isinstance(cache, lrucache):
+                raise TypeError
+
+        return cache
@@ -2,7 +2,15 @@
 # SPDX-License-Identifier: MIT
 
 from pylru import *
+import copy
+import gc
+import logging
+import os
+import pickle
 import random
+import tempfile
+import threading
+import time
 
 # This tests PyLRU by fuzzing it with random operations, then checking the
 # results against another, simpler, LRU cache implementation.
@@ -128,6 +136,184 @@ def testcache():
     test(a, b, a, b, verify)
 
 
+class recordingobserver(lruobserver):
+    def __init__(self):
+        self.events = []
+
+    def hit(self, key):
+        self.events.append(('hit', key))
+
+    def miss(self, key):
+        self.events.append(('miss', key))
+
+    def insert(self, key, value):
+        self.events.append(('insert', key, value))
+
+    def update(self, key, value):
+        self.events.append(('update', key, value))
+
+    def evict(self, key, value, age):
+        self.events.append(('evict', key, value, age))
+
+    def resize(self, oldsize, newsize):
+        self.events.append(('resize', oldsize, newsize))
+
+    def clear(self):
+        self.events.append(('clear',))
+
+
+def testobserver():
+    ejected = []
+    def callback(key, value):
+        ejected.append((key, value))
+
+    a = lrucache(3, callback)
+    a[0] = 0
+    r = recordingobserver()
+    a.addobserver(r)
+    assert type(a) is not lrucache and isinstance(a, lrucache)
+
+    a[1] = 1
+    a[2] = 2
+    a[1] = 10
+    assert a[2] == 2
+    assert a.get(5) is None
+    try:
+        a[6]
+    except KeyError:
+        pass
+    a[3] = 3
+    a[4] = 4
+    a.size(1)
+    a.clear()
+
+    assert r.events == [('insert', 1, 1), ('insert', 2, 2),
+                        ('update', 1, 10), ('hit', 2), ('miss', 5),
+                        ('miss', 6), ('evict', 0, 0, 5), ('insert', 3, 3),
+                        ('evict', 1, 10, 3), ('insert', 4, 4),
+                        ('evict', 2, 2, 2), ('evict', 3, 3, 1),
+                        ('resize', 3, 1), ('clear',)]
+    assert ejected == [(0, 0), (1, 10), (2, 2), (3, 3)]
+
+    # Copies are not observed.
+    a.callback = None
+    a[5] = 5
+    b = pickle.loads(pickle.dumps(a))
+    assert type(b) is lrucache
+    assert list(b.items()) == [(5, 5)]
+    b = copy.deepcopy(a)
+    assert type(b) is lrucache
+
+    a.removeobserver(r)
+    assert type(a) is lrucache
+    a[6] = 6
+    assert r.events[-1] == ('insert', 5, 5)
+
+    # Observed caches behave the same as unobserved ones.
+    def verify(a, b):
+        assert list(a.items()) == [tuple(x) for x in b.cache[::-1]]
+
+    s = samplingobserver(10, 2)
+    a = lrucache(64)
+    a.addobserver(s)
+    b = simplelrucache(64)
+    test(a, b, a, b, verify)
+    a.size(16)
+    b.resize(16)
+    test(a, b, a, b, verify)
+
+    assert s.inserts > 0 and s.hits > 0 and s.evictions > 0
+    assert s.evictions == sum(count for age, count in s.agehistogram())
+    assert len(s.counts) <= 10
+    assert len(s.hottest(3)) == 3
+    assert sum(count for key, count in s.hottest(10)) == (s.hits +
+                                                           s.misses) // 2
+
+    # The buckets of the Space-Saving counts stay consistent with them.
+    s = samplingobserver(10000)
+    for i in range(100000):
+        s.miss(i if i % 2 else i % 100)
+    assert len(s.counts) == 10000
+    assert s.mincount == min(s.counts.values())
+    for count, bucket in s.buckets.items():
+        for key in bucket:
+            assert s.counts[key] == count
+    assert sum(len(bucket) for bucket in s.buckets.values()) == 10000
+    assert set(key for key, count in s.hottest(50)) == set(range(0, 100, 2))
+
+
+# Counts the times the least recently used node had to be searched for,
+# rather than being found through the hint.
+class searchcountinglrucache(lrucache):
+    searches = 0
+
+    def lrunode(self):
+        hint = self.lruHint
+        node = lrucache.lrunode(self)
+        if node is not hint:
+            self.searches += 1
+        return node
+
+
+def testends():
+    a = lrucache(64)
+    b = simplelrucache(64)
+    for i in range(4000):
+        x = random.randint(0, 100)
+        op = random.randint(0, 7)
+        if op < 3:
+            a[x] = x
+            b[x] = x
+        elif op == 3 and x in b:
+            a.move_to_end(x)
+            b[x]
+        elif op == 4 and x in b:
+            a.move_to_end(x, last=False)
+            for j in range(len(b.cache)):
+                if b.cache[j][0] == x:
+                    b.cache.insert(0, b.cache.pop(j))
+                    break
+        elif op == 5 and len(b.cache) > 0:
+            assert a.popitem(last=bool(x % 2)) == tuple(b.cache.pop(-(x % 2)))
+        elif op == 6 and len(b.cache) > 0:
+            assert a.peek_lru() == tuple(b.cache[0])
+        elif op == 7:
+            assert (list(a.iter_lru(x % 10)) ==
+                    [tuple(y) for y in b.cache[:x % 10]])
+
+        if i % 500 == 0:
+            size = random.randint(1, 100)
+            a.size(size)
+            b.resize(size)
+
+        assert list(a.items()) == [tuple(y) for y in b.cache[::-1]]
+        assert list(a.iter_lru()) == [tuple(y) for y in b.cache]
+
+    # Working on the least recently used end one item at a time takes time
+    # proportional to the number of items, even when the cache is not full.
+    # Only the first lookup of the least recently used node has to walk the
+    # list; after that it is found through 'lruHint'.
+    a = searchcountinglrucache(1000)
+    for i in range(800):
+        a[i] = i
+    for i in range(400):
+        assert a.peek_lru() == (i, i)
+        assert a.popitem(last=False) == (i, i)
+    for i in range(400, 600):
+        a.move_to_end(i + 200, last=False)
+        assert next(a.iter_lru(1)) == (i + 200, i + 200)
+    assert a.searches == 1
+    assert len(a) == 400
+
+    a.clear()
+    assert list(a.iter_lru()) == []
+    try:
+        a.peek_lru()
+        assert False
+    except KeyError:
+        pass
+
+
 def wraptest():
     def verify(p, x):
         assert p == x.store
@@ -200,6 +386,64 @@ def wraptest3():
     assert p == q
 
 
+class countingdict(dict):
+    # A dict that counts the lookups made in it.
+    def __init__(self):
+        self.lookups = 0
+
+    def __contains__(self, key):
+        self.lookups += 1
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return dict.__getitem__(self, key)
+
+
+def negativetest():
+    for writeback in (False, True):
+        q = countingdict()
+        x = lruwrap(q, 4, writeback, negsize=8)
+
+        assert 'a' not in x
+        assert x.get('a') is None
+        assert 'a' not in x
+        assert q.lookups == 1
+
+        x['a'] = 1
+        assert x['a'] == 1
+        assert 'a' in x
+
+        del x['a']
+        lookups = q.lookups
+        assert x.get('a') is None
+        assert q.lookups == lookups
+
+        # Keys added to the store directly are found once the ttl expires.
+        q = countingdict()
+        x = lruwrap(q, 4, writeback, negsize=8, negttl=0.01)
+        assert 'b' not in x
+        q['b'] = 2
+        assert 'b' not in x
+        time.sleep(0.02)
+        assert x['b'] == 2
+
+        # The results are the same as without negative caching.
+        p = dict()
+        q = dict()
+        x = lruwrap(q, 16, writeback, negsize=16)
+        for i in range(1000):
+            key = random.randint(0, 64)
+            if random.random() < 0.3:
+                p[key] = x[key] = random.randint(0, 64)
+            elif random.random() < 0.1 and key in p:
+                del p[key]
+                del x[key]
+            else:
+                assert x.get(key) == p.get(key)
+                assert (key in x) == (key in p)
+
+
 @lrudecorator(100)
 def square(x):
     return x*x
@@ -210,6 +454,519 @@ def testDecorator():
         assert square(x) == x*x
 
 
+def testgdsf():
+    ejected = []
+    def callback(key, value):
+        ejected.append(key)
+
+    # Cheap entries are ejected before expensive ones, regardless of
+    # recency.
+    a = gdsfcache(3, callback)
+    a.insert('expensive', 1, cost=100)
+    a.insert('cheap1', 2, cost=1)
+    a.insert('cheap2', 3, cost=1)
+    a['cheap2']
+    a.insert('new', 4, cost=1)
+    assert ejected == ['cheap1']
+    assert 'expensive' in a
+
+    # Aging eventually ejects expensive entries that are no longer used.
+    for i in range(200):
+        a.insert(i, i, cost=1)
+    assert 'expensive' not in a
+    assert len(a) == 3
+
+    # Large entries are ejected before small ones of equal cost.
+    a.clear()
+    del ejected[:]
+    a.insert('small', 1, cost=1, size=1)
+    a.insert('large', 2, cost=1, size=10)
+    a.insert('medium', 3, cost=1, size=2)
+    a.insert('new', 4, cost=1, size=1)
+    assert ejected == ['large']
+
+    a.size(1)
+    assert len(a) == 1
+    assert list(a.keys()) == ['new']
+
+    a.size(3)
+    a.update({'x': 1}, y=2)
+    assert a.popitem() == ('new', 4)
+    assert len(a) == 2
+    a.popitem()
+    a.popitem()
+    try:
+        a.popitem()
+        assert False
+    except KeyError:
+        pass
+
+    a = gdsfcache(10)
+    for i in range(1000):
+        x = random.randint(0, 20)
+        a[x] = x
+        assert a[x] == x
+        assert len(a) <= 10
+        assert len(a.heap) <= 2 * len(a) + 17
+
+    for key, value in a.items():
+        assert key == value
+
+
+def testCostAware():
+    def slow(x):
+        if x == 0:
+            time.sleep(0.01)
+        return x
+
+    cached = FunctionCacheManager(slow, 3, costaware=True)
+    for x in range(50):
+        assert cached(x) == x
+    assert ((0,), ()) in cached.cache
+
+    @lrudecorator(100, costaware=True, sizeof=len)
+    def repeat(x):
+        return 'a' * x
+
+    for i in range(1000):
+        x = random.randint(0, 200)
+        assert repeat(x) == 'a' * x
+    assert len(repeat.cache) == 100
+
+    # The cache is available before decorating, and each function decorated
+    # with the same decorator gets a manager of its own.
+    decorator = lrudecorator(10, costaware=True)
+    assert isinstance(decorator.cache, gdsfcache)
+    double = decorator(lambda x: 2 * x)
+    triple = decorator(lambda x: 3 * x)
+    assert double.cache is decorator.cache
+    assert double(2) == 4 and triple(2) == 6
+    assert isinstance(lrudecorator(10).cache, lrucache)
+
+
+def testtiered():
+    def verify(a, b):
+        assert list(a.keys()) == [x[0] for x in b.cache[::-1]]
+        assert list(a.items()) == [tuple(x) for x in b.cache[::-1]]
+
+        # Check the bookkeeping of the disk tier.
+        disk = a.disk
+        live = sum(location[2] for location in disk.index.values())
+        assert live == disk.liveBytes
+        assert live == sum(x.live for x in disk.segments.values())
+        assert (disk.deadBytes == sum(x.total - x.live
+                                      for x in disk.segments.values()))
+
+    ejected = []
+    def callback(key, value):
+        ejected.append(key)
+
+    with tieredcache(16, 48, callback=callback, segmentsize=256) as a:
+        b = simplelrucache(64)
+        test(a, b, a, b, verify)
+
+        a.size(8)
+        b.resize(56)
+        verify(a, b)
+        test(a, b, a, b, verify)
+
+        # Shrinking the disk tier only ejects items from disk, even if the
+        # memory tier is not full.
+        a.disksize(16)
+        b.resize(len(a.memory) + 16)
+        b.size = 24
+        verify(a, b)
+        test(a, b, a, b, verify)
+
+        assert ejected
+        assert len(a.disk.segments) < 16
+
+        # popitem() takes the most recently used item from memory and the
+        # least recently used one from disk.
+        a.size(4)
+        a.disksize(4)
+        for i in range(8):
+            a[i] = i
+        assert a.setdefault(7, 'x') == 7 and a.setdefault(8, 'x') == 'x'
+        assert a.popitem() == (8, 'x')
+        assert a.popitem(last=False) == (1, 1)
+        assert a.disk.popitem() == (4, 4)
+        assert list(a.keys()) == [7, 6, 5, 3, 2]
+        assert a.popitem(last=False) == (2, 2)
+        assert a.popitem(last=False) == (3, 3)
+        assert a.disk.setdefault(9, 'y') == 'y'
+        assert a.disk.popitem(last=False) == (9, 'y')
+        assert a.popitem(last=False) == (5, 5)
+
+        a.clear()
+        assert len(a) == 0
+        assert list(a.items()) == []
+        try:
+            a.popitem()
+            assert False
+        except KeyError:
+            pass
+
+    assert not os.path.exists(a.disk.directory)
+
+    # A cache that is never closed removes its files when it is collected.
+    a = tieredcache(1, 8)
+    for i in range(8):
+        a[i] = i
+    directory = a.disk.directory
+    assert os.path.exists(directory)
+    del a
+    gc.collect()
+    assert not os.path.exists(directory)
+
+
+def testdiskshared():
+    # Caches sharing a directory do not see each other's records, and each
+    # removes only its own files.
+    with tempfile.TemporaryDirectory() as directory:
+        a = disklrucache(100, directory, segmentsize=64, maxopen=2)
+        b = disklrucache(100, directory, segmentsize=64, maxopen=2)
+        for i in range(100):
+            a[i] = 'A' * (i % 7)
+            b[i] = 'B' * (i % 7)
+
+        for i in range(100):
+            assert a[i] == 'A' * (i % 7)
+            assert b.peek(i) == 'B' * (i % 7)
+
+        assert len(a.segments) > 2
+        assert len(a.files) <= 2
+
+        a.close()
+        assert list(b.items()) == [(i, 'B' * (i % 7))
+                                   for i in reversed(range(100))]
+        b.close()
+        assert os.listdir(directory) == []
+
+
+def testtieredstore():
+    p = dict()
+    with tieredcache(8, 1024, segmentsize=1024) as q:
+        x = lruwrap(q, 16, True)
+        for i in range(1000):
+            key = random.randint(0, 512)
+            value = random.randint(0, 512)
+            p[key] = value
+            x[key] = value
+            key = random.randint(0, 512)
+            assert x.get(key) == p.get(key)
+
+        x.sync()
+        assert dict(q.items()) == p
+
+
+def testRefresh():
+    calls = []
+    def func(x):
+        calls.append(x)
+        return (x, len(calls))
+
+    cached = FunctionCacheManager(func, 10, softttl=0.05, hardttl=10)
+    assert cached(1) == (1, 1)
+    assert cached(1) == (1, 1)
+    assert len(calls) == 1
+
+    # A stale result is returned while it is recomputed in the background.
+    time.sleep(0.06)
+    assert cached(1) == (1, 1)
+    for i in range(100):
+        if cached(1) != (1, 1):
+            break
+        time.sleep(0.01)
+    assert cached(1) == (1, 2)
+    assert calls == [1, 1]
+
+    # Concurrent refreshes of the same result are not started.
+    started = threading.Event()
+    release = threading.Event()
+    def slow(x):
+        calls.append(x)
+        if len(calls) > 1:
+            started.set()
+            release.wait()
+        return len(calls)
+
+    del calls[:]
+    cached = FunctionCacheManager(slow, 10, softttl=0.01, refreshworkers=4)
+    assert cached(2) == 1
+    time.sleep(0.02)
+    assert cached(2) == 1
+    started.wait()
+    for i in range(10):
+        assert cached(2) == 1
+    assert len(calls) == 2
+    release.set()
+    cached.close()
+    assert cached.executor is None
+    assert cached(2) == 2
+
+    # Results older than the hard ttl are recomputed before returning.
+    @lrudecorator(10, softttl=10, hardttl=0.01)
+    def counter(x):
+        calls.append(x)
+        return len(calls)
+
+    del calls[:]
+    assert counter(3) == 1
+    assert counter(3) == 1
+    time.sleep(0.02)
+    assert counter(3) == 2
+
+    counter.size(1)
+    assert counter(4) == 3
+    assert counter(3) == 4
+    assert len(counter.cache) == 1
+    counter.close()
+
+    with FunctionCacheManager(func, 10, softttl=0.01) as cached:
+        cached(5)
+        time.sleep(0.02)
+        cached(5)
+    assert cached.executor is None
+
+    # A refresh submitted to an executor that close() has shut down is
+    # skipped, without failing the call that started it.
+    cached = FunctionCacheManager(func, 10, softttl=0.0001, refreshworkers=2)
+    cached(6)
+    cached.close()
+    cached.executor = ThreadPoolExecutor(1)
+    cached.executor.shutdown()
+    time.sleep(0.001)
+    assert cached(6)[0] == 6
+    assert not cached.refreshing
+
+    # Calls starting refreshes while other threads close the manager.
+    failures = []
+    def caller():
+        try:
+            for i in range(500):
+                assert cached(i % 4)[0] == i % 4
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=caller) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        cached.close(wait=False)
+    for thread in threads:
+        thread.join()
+    cached.close()
+    assert not failures
+    assert not cached.refreshing
+
+
+def cube(x, offset=0):
+    if x < 0:
+        raise ValueError
+    return x*x*x + offset
+
+
+def crash(x):
+    if x < 0:
+        os._exit(1)
+    return x
+
+
+def testParallel():
+    with ParallelFunctionCacheManager(cube, 50, maxworkers=2,
+                                      chunksize=4) as cached:
+        assert cached(3) == 27
+        assert cached(3, offset=1) == 28
+        assert len(cached.cache) == 2
+
+        xs = [random.randint(0, 100) for i in range(200)]
+        assert cached.map(xs) == [x*x*x for x in xs]
+        assert len(cached.cache) == 50
+        assert cached.inflight == {}
+
+        assert cached.map(range(5), [1] * 5) == [x*x*x + 1 for x in range(5)]
+
+        try:
+            cached(-1)
+            assert False
+        except ValueError:
+            pass
+        assert cached.inflight == {}
+
+        # A failing call only fails its own result. The rest of its batch is
+        # cached.
+        cached.clear()
+        try:
+            cached.map([1, 2, 3, -1, 5])
+            assert False
+        except ValueError:
+            pass
+        assert cached(5) == 125
+        assert cached.inflight == {}
+        assert sorted(cached.cache.keys()) == [((x,), ()) for x in (1, 2, 3, 5)]
+
+        # Concurrent calls for the same result share one computation.
+        results = []
+        def call():
+            results.append(cached(1000))
+        threads = [threading.Thread(target=call) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [1000 ** 3] * 8
+
+    # A callback raising while the results are cached does not leave callers
+    # waiting. The exception is logged by concurrent.futures.
+    def callback(key, value):
+        raise RuntimeError
+
+    logger = logging.getLogger('concurrent.futures')
+    logger.disabled = True
+    try:
+        with ParallelFunctionCacheManager(cube, 1, callback,
+                                          chunksize=2) as cached:
+            assert cached.map([1, 2, 3]) == [1, 8, 27]
+            assert cached(4) == 64
+            assert cached.inflight == {}
+    finally:
+        logger.disabled = False
+
+    # A worker process dying breaks the pool. The next call starts a new one.
+    with ParallelFunctionCacheManager(crash, 10, maxworkers=1) as cached:
+        assert cached(1) == 1
+        try:
+            cached(-1)
+            assert False
+        except BrokenProcessPool:
+            pass
+        assert cached.inflight == {}
+        assert cached(2) == 2
+        assert cached.map([3, 4]) == [3, 4]
+
+
+def testBudget():
+    @lrudecorator(40)
+    def hot(x):
+        return x
+
+    cold = lruwrap(dict(), 40)
+    other = lrucache(40)
+
+    budget = CacheBudgetManager(90, step=10, interval=100)
+    budget.register(hot)
+    budget.register(cold)
+    budget.register(other)
+    assert budget.total() == 90
+    assert hot.size() + cold.size() + other.size() == 90
+
+    # A working set of 45 keys gets no hits from an LRU cache of 40, while
+    # random keys from a large set rarely hit at any size.
+    for i in range(5000):
+        hot(i % 45)
+        x = random.randint(0, 100000)
+        cold[x] = x
+        assert cold[x] == x
+
+    assert hot.size() >= 45
+    assert budget.total() <= 90
+
+    stats = budget.stats()
+    assert stats[0][0] is hot.cache
+    assert stats[0][3] > 0
+
+    before = cold.size()
+    budget.unregister(cold)
+    assert type(cold.cache) is lrucache
+    assert cold.size() == before
+
+    try:
+        budget.register(FunctionCacheManager(hot, 10, costaware=True))
+        assert False
+    except TypeError:
+        pass
+
+    # A cache can only be registered once, however it is reached.
+    for cache in (hot, hot.cache):
+        try:
+            budget.register(cache)
+            assert False
+        except ValueError:
+            pass
+    assert len(budget.members) == 2
+
+    # Caches used by refresh threads and worker callbacks are resized under
+    # their owners' locks.
+    def verify(cache):
+        nodes = list(cache.dli())
+        assert len(nodes) == len(cache) <= cache.size()
+        assert all(cache.table[node.key] is node for node in nodes)
+
+    budget = CacheBudgetManager(60, step=5, interval=10)
+    refreshed = FunctionCacheManager(cube, 30, softttl=0.001,
+                                     refreshworkers=4)
+    with ParallelFunctionCacheManager(cube, 30, maxworkers=2) as parallel:
+        budget.register(refreshed)
+        budget.register(parallel)
+
+        def work():
+            for i in range(300):
+                x = random.randint(0, 60)
+                assert refreshed(x) == x*x*x
+                assert parallel(x) == x*x*x
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        refreshed.close()
+        verify(refreshed.cache)
+        verify(parallel.cache)
+        assert budget.total() <= 60
+
+    # Rebalances started by other threads, or by their refresh threads, do
+    # not resize a plain cache used by this thread. It is resized when this
+    # thread next uses it.
+    class resizerecorder(lruobserver):
+        def __init__(self):
+            self.threads = set()
+
+        def resize(self, oldsize, newsize):
+            self.threads.add(threading.current_thread())
+
+    budget = CacheBudgetManager(40, step=2, interval=5)
+    plain = lrucache(20)
+    refreshed = FunctionCacheManager(cube, 20, softttl=0.0001,
+                                     refreshworkers=4)
+    budget.register(plain)
+    budget.register(refreshed)
+    recorder = resizerecorder()
+    plain.addobserver(recorder)
+
+    def work():
+        for i in range(2000):
+            x = random.randint(0, 30)
+            assert refreshed(x) == x*x*x
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    while thread.is_alive():
+        x = random.randint(0, 30)
+        try:
+            assert plain[x] == x
+        except KeyError:
+            plain[x] = x
+    thread.join()
+
+    refreshed.close()
+    assert recorder.threads == {threading.current_thread()}
+    verify(plain)
+    assert budget.total() <= 40
+
+
 if __name__ == '__main__':
     random.seed()
 
@@ -219,3 +976,15 @@ if __name__ == '__main__':
         wraptest2()
         wraptest3()
         testDecorator()
+        negativetest()
+        testgdsf()
+        testtieredstore()
+
+    testobserver()
+    testends()
+    testCostAware()
+    testRefresh()
+    testParallel()
+    testBudget()
+    testtiered()
+    testdiskshared()